@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Network of Mycell neurons (model downloaded from the Allen cell types
+# database). A current clamp drives the first neuron and the spike
+# propagates through the network via ExpSyn synapses.
+
+# In[1]:
+
+import gc
+
+import numpy
+from matplotlib import pyplot
+from neuron import h
+from neuron import coreneuron
+from neuron.units import mV
+from neuronpy.graphics import spikeplot
+from neuronpy.util import spiketrain
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# In[2]:
+
+# Pick up MPI when launched under mpiexec; without it this is a
+# single-rank no-op (and absent on older NEURONs).
+try:
+    h.nrnmpi_init()
+except AttributeError:
+    pass
+
+# h.load_file re-parses the hoc every call; on notebook-style
+# re-execution the run system and template are already compiled, so
+# skip the parse entirely.
+if not hasattr(h, "tstop"):
+    h.load_file("stdrun.hoc")
+if not hasattr(h, "Mycell"):
+    h.load_file("myneuron.hoc")
+cell1 = h.Mycell()
+pc = h.ParallelContext()
+
+# Run the integration through CoreNEURON so the hh/pas kernels execute
+# as SoA-vectorized compiled code instead of NEURON's per-segment loop
+# (set gpu = True as well to offload to a GPU build). The model only
+# uses built-in mechanisms, so no nrnivmodl -coreneuron step is needed.
+use_coreneuron = False
+coreneuron.enable = use_coreneuron
+coreneuron.gpu = False
+
+# Variable-step integration: sub-threshold trials in the amplitude sweep
+# are mostly flat, so CVODE covers them in tens of steps instead of the
+# 1000 fixed dt=0.025 steps per 25 ms run. CoreNEURON is fixed-step
+# only, so CVODE stays off when it is enabled.
+cvode = h.CVode()
+if not use_coreneuron:
+    cvode.active(1)
+cvode.atol(1e-3)
+
+# Every figure in the script uses the same size; set it once instead of
+# passing figsize to each figure()/subplots() call.
+pyplot.rcParams['figure.figsize'] = (10, 5)
+
+
+# In[3]:
+
+def attach_current_clamp(cell, delay=5, dur=1, amp=.1, loc=0.5):
+    """Attach a current clamp to the soma of a cell.
+
+    :param cell: cell object to attach the current clamp to
+    :param delay: onset of the injected current (ms)
+    :param dur: duration of the stimulus (ms)
+    :param amp: amplitude of the injected current (nA)
+    :param loc: position on the soma (0 to 1)
+    """
+    stim = h.IClamp(cell.soma(loc))
+    stim.delay = delay
+    stim.dur = dur
+    stim.amp = amp
+    return stim
+
+
+def set_recording_vectors(cell, tstop=25):
+    """Set soma and time recording vectors on a cell.
+
+    The vectors are pre-sized for a fixed-step run of tstop ms so NEURON
+    never has to grow (realloc and copy) them while recording.
+
+    :param cell: cell to record from
+    :param tstop: duration of the run the vectors will record (ms)
+    :return: the soma voltage and time vectors
+    """
+    n = int(tstop / h.dt) + 2
+    soma_v_vec = h.Vector()
+    t_vec = h.Vector()
+    soma_v_vec.buffer_size(n)
+    t_vec.buffer_size(n)
+    soma_v_vec.record(cell.soma(0.5)._ref_v)
+    t_vec.record(h._ref_t)
+    return soma_v_vec, t_vec
+
+
+def simulate(tstop=25):
+    """Initialize and run a simulation.
+
+    :param tstop: duration of the simulation (ms)
+    """
+    h.tstop = tstop
+    if coreneuron.enable:
+        pc.set_maxstep(10)
+        h.stdinit()
+        pc.psolve(tstop)
+    else:
+        # finitialize + continuerun skips the full stdinit re-setup that
+        # h.run() pays on every invocation.
+        h.finitialize(-65 * mV)
+        h.fcurrent()
+        h.continuerun(tstop)
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _group_spike_times(times, ids, n):
+        # Counting sort by NetCon id: one pass to size each train, one
+        # pass to scatter the times into a flat array split by offsets.
+        counts = numpy.zeros(n + 1, numpy.int64)
+        for k in range(ids.size):
+            counts[ids[k] + 1] += 1
+        offsets = numpy.cumsum(counts)
+        out = numpy.empty(times.size, numpy.float64)
+        fill = offsets[:-1].copy()
+        for k in range(times.size):
+            j = ids[k]
+            out[fill[j]] = times[k]
+            fill[j] += 1
+        return out, offsets
+
+
+def group_spikes(t_vec, id_vec, n):
+    """Group recorded NetCon events into one spike-time list per id.
+
+    :param t_vec: vector of event times
+    :param id_vec: vector of NetCon ids, parallel to t_vec
+    :param n: number of NetCons recorded
+    :return: list of n spike-time arrays
+    """
+    if njit is None:
+        return spiketrain.netconvecs_to_listoflists(t_vec, id_vec)
+    times = t_vec.as_numpy()
+    ids = id_vec.as_numpy().astype(numpy.int64)
+    out, offsets = _group_spike_times(times, ids, n)
+    return [out[offsets[i]:offsets[i + 1]] for i in range(n)]
+
+
+def _hh_trace(i_density, delay, dur, tstop, dt):
+    # Single-compartment squid HH soma with the same parameters the
+    # template inserts; forward Euler on NEURON's default dt. Compiled
+    # by Numba below when it is available.
+    gnabar, gkbar, gl = 0.12, 0.036, 0.0003
+    ena, ek, el = 50.0, -77.0, -54.3
+    n_steps = int(tstop / dt) + 1
+    trace = numpy.empty(n_steps, numpy.float64)
+    v = -65.0
+    am = 0.1 * (v + 40.0) / (1.0 - numpy.exp(-(v + 40.0) / 10.0))
+    bm = 4.0 * numpy.exp(-(v + 65.0) / 18.0)
+    ah = 0.07 * numpy.exp(-(v + 65.0) / 20.0)
+    bh = 1.0 / (1.0 + numpy.exp(-(v + 35.0) / 10.0))
+    an = 0.01 * (v + 55.0) / (1.0 - numpy.exp(-(v + 55.0) / 10.0))
+    bn = 0.125 * numpy.exp(-(v + 65.0) / 80.0)
+    m = am / (am + bm)
+    hg = ah / (ah + bh)
+    n = an / (an + bn)
+    for k in range(n_steps):
+        trace[k] = v
+        t = k * dt
+        i_stim = i_density if delay <= t < delay + dur else 0.0
+        ina = gnabar * m ** 3 * hg * (v - ena)
+        ik = gkbar * n ** 4 * (v - ek)
+        il = gl * (v - el)
+        v += dt * (i_stim - ina - ik - il)
+        am = 0.1 * (v + 40.0) / (1.0 - numpy.exp(-(v + 40.0) / 10.0))
+        bm = 4.0 * numpy.exp(-(v + 65.0) / 18.0)
+        ah = 0.07 * numpy.exp(-(v + 65.0) / 20.0)
+        bh = 1.0 / (1.0 + numpy.exp(-(v + 35.0) / 10.0))
+        an = 0.01 * (v + 55.0) / (1.0 - numpy.exp(-(v + 55.0) / 10.0))
+        bn = 0.125 * numpy.exp(-(v + 65.0) / 80.0)
+        m += dt * (am * (1.0 - m) - bm * m)
+        hg += dt * (ah * (1.0 - hg) - bh * hg)
+        n += dt * (an * (1.0 - n) - bn * n)
+    return trace
+
+
+if njit is not None:
+    _hh_trace = njit(cache=True, fastmath=True)(_hh_trace)
+
+
+def simulate_soma_only(amps, tstop=25, delay=5, dur=1):
+    """Amplitude sweep on a single-compartment HH soma, without NEURON.
+
+    The threshold behavior in the sweep is dominated by the somatic HH
+    equation, so a compiled point-model integrator reproduces the
+    figure at a fraction of the cost of the full multi-compartment
+    solve — handy for exploratory parameter fitting. The network
+    experiments keep the full NEURON path.
+
+    :param amps: clamp amplitudes, one trial per entry (nA)
+    :param tstop: duration of each trial (ms)
+    :param delay: onset of the injected current (ms)
+    :param dur: duration of the stimulus (ms)
+    :return: the time grid and a (n_trials, n_samples) float32 V array
+    """
+    dt = h.dt
+    area = cell1.soma(0.5).area()
+    t = numpy.arange(int(tstop / dt) + 1) * dt
+    # nA over um2 -> mA/cm2 is a factor of 100
+    V = numpy.vstack([_hh_trace(100.0 * amp / area, delay, dur, tstop, dt)
+                      for amp in amps]).astype(numpy.float32)
+    return t, V
+
+
+def build_network(n, connections, weight=1, delay=10, gid_base=0):
+    """Build n cells wired up by the (src, dst) pairs in connections.
+
+    Cells, synapses and NetCons come back as parallel lists indexed by
+    cell id, so a whole network can be dropped (del + gc.collect) before
+    the next one is built — an individually named NetCon left over from
+    an earlier experiment would otherwise keep firing into later runs.
+
+    Every cell is registered with a global id (gid_base + its index)
+    through the template's connect2target spike detector, so one
+    pc.spike_record(-1, ...) call captures the whole network's spikes.
+    Rebuilding from gid 0 requires pc.gid_clear() first.
+
+    :param n: number of cells
+    :param connections: list of (src, dst) cell-index pairs
+    :param weight: synaptic weight for every connection
+    :param delay: synaptic delay for every connection (ms)
+    :param gid_base: first global id to assign to the cells
+    :return: the cells, synapses and NetCons as parallel lists
+    """
+    cells = [h.Mycell() for _ in range(n)]
+    for i, cell in enumerate(cells):
+        cell.position(0, 250 * i, 0)
+        pc.set_gid2node(gid_base + i, pc.id())
+        pc.cell(gid_base + i, cell.connect2target(None))
+    syns = []
+    ncs = []
+    for src, dst in connections:
+        syn = h.ExpSyn(cells[dst].dend[0](0.5))
+        nc = h.NetCon(cells[src].soma(0.5)._ref_v, syn, sec=cells[src].soma)
+        nc.weight[0] = weight
+        nc.delay = delay
+        syns.append(syn)
+        ncs.append(nc)
+    return cells, syns, ncs
+
+
+def build_ring(n, weight=1, delay=10):
+    """Build a ring of n cells, each one driving the next.
+
+    :param n: number of cells
+    :param weight: synaptic weight for every connection
+    :param delay: synaptic delay for every connection (ms)
+    :return: the cells, synapses and NetCons as parallel lists
+    """
+    return build_network(n, [(i, (i + 1) % n) for i in range(n)],
+                         weight=weight, delay=delay)
+
+
+def clear_network():
+    """Release whatever network objects were just del-ed.
+
+    gc.collect() makes NEURON drop the deleted cells and point
+    processes right away, and gid_clear frees their global ids for the
+    next build_network to reuse.
+    """
+    gc.collect()
+    pc.gid_clear()
+
+
+def record_network(cells, tstop):
+    """Set pre-sized recording vectors on every cell of a network.
+
+    :param cells: cells to record from
+    :param tstop: duration of the run the vectors will record (ms)
+    :return: list of (soma_v_vec, t_vec) pairs, one per cell
+    """
+    return [set_recording_vectors(cell, tstop=tstop) for cell in cells]
+
+
+def network_traces(recs):
+    """Gather recorded traces into one contiguous (cells, samples) array.
+
+    All cells share the same time grid, so one strided copy out of the
+    per-cell record buffers after the run gives plotting and analysis a
+    single cache-friendly 2D block instead of N scattered HOC buffers.
+    The per-step recording work itself stays inside NEURON's C
+    recorders.
+
+    The voltages are archived as float32: the 0.006 mV resolution near
+    rest is ample for plotting and spike analysis, and halving the
+    bytes halves the bandwidth every downstream pass over the traces
+    pays. NEURON still integrates and records in double precision.
+
+    :param recs: list of (soma_v_vec, t_vec) pairs from record_network
+    :return: the time grid and a (n_cells, n_samples) float32 V array
+    """
+    t = recs[0][1].as_numpy().copy()
+    V = numpy.vstack([v.as_numpy() for v, _ in recs]).astype(numpy.float32)
+    return t, V
+
+
+def build_batch(k, n=1, connections=(), weight=1, delay=10):
+    """Build k disconnected copies of a network in this process.
+
+    The copies share one NEURON context, so matrix setup, mechanism
+    lists and the Python/HOC transitions of a run are paid once for all
+    k trials; the sparse solver decomposes naturally along the
+    disconnected cells.
+
+    :param k: number of network copies
+    :param n: number of cells per copy
+    :param connections: list of (src, dst) cell-index pairs per copy
+    :param weight: synaptic weight for every connection
+    :param delay: synaptic delay for every connection (ms)
+    :return: list of (cells, syns, ncs) tuples, one per copy
+    """
+    return [build_network(n, list(connections), weight=weight, delay=delay,
+                          gid_base=i * n)
+            for i in range(k)]
+
+
+def batch_sweep(amps, tstop=25):
+    """Run all amplitude trials batched into a single integration.
+
+    One disconnected copy of the cell per amplitude, each with its own
+    clamp, all integrated in one run — the per-run overhead is
+    amortized across the whole sweep instead of paid per trial.
+
+    :param amps: clamp amplitudes, one trial per entry (nA)
+    :param tstop: duration of each trial (ms)
+    :return: the time grid and a (n_trials, n_samples) voltage array
+    """
+    batch = build_batch(len(amps))
+    stims = [attach_current_clamp(cells[0], amp=amp)
+             for (cells, _, _), amp in zip(batch, amps)]
+    recs = record_network([cells[0] for cells, _, _ in batch], tstop)
+    simulate(tstop)
+    return network_traces(recs)
+
+
+def show_output(soma_v_vec, t_vec, new_fig=True):
+    """Plot the somatic membrane potential against time.
+
+    :param soma_v_vec: membrane potential vector
+    :param t_vec: time vector
+    :param new_fig: flag to create a new figure (or use current figure)
+    """
+    if new_fig:
+        pyplot.figure()
+    pyplot.plot(t_vec.as_numpy(), soma_v_vec.as_numpy(), color='black')
+    pyplot.xlabel('time (ms)')
+    pyplot.ylabel('mV')
+
+
+def run_amp(amp, tstop=25):
+    """Run one amplitude trial and return copies of its t and V traces.
+
+    This is the per-process trial runner for distributed sweeps: every
+    MPI rank (or worker process) has its own NEURON kernel with one
+    clean cell1, so the trials share no simulator state.
+
+    :param amp: amplitude of the injected current (nA)
+    :param tstop: duration of the trial (ms)
+    :return: time and soma voltage as numpy arrays (voltage as float32)
+    """
+    stim = attach_current_clamp(cell1, amp=amp)
+    soma_v_vec, t_vec = set_recording_vectors(cell1, tstop=tstop)
+    simulate(tstop)
+    return (t_vec.as_numpy().copy(),
+            soma_v_vec.as_numpy().astype(numpy.float32))
+
+
+# Each experiment is a function so its locals (clamps, synapses,
+# NetCons) die with the scope and nothing stale leaks into the next
+# run; main() sequences them across MPI ranks.
+
+# Default sweep amplitudes (nA), hoisted to module level so re-runs
+# reuse the array; one broadcast multiply, no linspace endpoint math.
+sweep_amps = 0.1 * numpy.arange(1, 9)
+
+
+def single_cell_experiment():
+    """Drive one cell with a current clamp and plot the response."""
+    stim = attach_current_clamp(cell1, amp=0.4)
+    soma_v_vec, t_vec = set_recording_vectors(cell1)
+    simulate()
+    show_output(soma_v_vec, t_vec)
+    pyplot.show()
+
+
+def amplitude_sweep_experiment(amps=sweep_amps):
+    """Sweep the clamp amplitude to find the spiking threshold.
+
+    The trials run as one batch of disconnected cell copies in a single
+    integration, amortizing the per-run overhead across the sweep; for
+    these short 25 ms trials that beats spawning a worker process per
+    amplitude (run_amp remains the per-process worker for that route).
+
+    :param amps: clamp amplitudes, one trial per entry (nA)
+    """
+    # Fast mode trades the multi-compartment morphology for the
+    # compiled somatic point model; flip it on when iterating on the
+    # sweep parameters.
+    fast_sweep = False
+    rank = int(pc.id())
+    nhost = int(pc.nhost())
+    if nhost > 1:
+        # Under mpiexec the trials round-robin across the ranks — they
+        # are embarrassingly parallel, so there is no spike exchange —
+        # and rank 0 gathers the traces for plotting. With CVODE active
+        # every trial records on its own variable-step grid (a
+        # sub-threshold trial takes far fewer steps than a spiking
+        # one), so each trial keeps its own time array.
+        mine = [(k, run_amp(amp)) for k, amp in enumerate(amps)
+                if k % nhost == rank]
+        gathered = pc.py_gather(mine, 0)
+        if rank != 0:
+            return
+        results = dict(kv for chunk in gathered for kv in chunk)
+        trials = [results[k] for k in range(len(amps))]
+    elif fast_sweep:
+        sweep_t, sweep_V = simulate_soma_only(amps)
+        trials = [(sweep_t, v) for v in sweep_V]
+    else:
+        sweep_t, sweep_V = batch_sweep(amps)
+        trials = [(sweep_t, v) for v in sweep_V]
+    # One Line2D per amplitude, filled in place with set_data: no new
+    # artist allocation, autoscale or legend rebuild inside the loop,
+    # only a single layout pass at the end.
+    fig, ax = pyplot.subplots()
+    lines = [ax.plot([], [], label='%.1f nA' % a)[0] for a in amps]
+    for k, (t, v) in enumerate(trials):
+        lines[k].set_data(t, v)
+    ax.relim()
+    ax.autoscale_view()
+    ax.set(xlabel='time (ms)', ylabel='mV')
+    ax.legend()
+    pyplot.show()
+
+
+def network_experiment(n, connections, tstop=150):
+    """Build a network, drive its first cell, and plot every soma trace.
+
+    :param n: number of cells
+    :param connections: list of (src, dst) cell-index pairs
+    :param tstop: duration of the run (ms)
+    """
+    clear_network()
+    cells, syns, ncs = build_network(n, connections)
+    stim = attach_current_clamp(cells[0], amp=0.4)
+    recs = record_network(cells, tstop)
+    simulate(tstop)
+    t, V = network_traces(recs)
+    fig = pyplot.figure()
+    for i, v in enumerate(V):
+        pyplot.plot(t, v, label='cell %d' % (i + 1))
+    ax = fig.gca()
+    ax.set(xlabel='time (ms)', ylabel='mV')
+    ax.legend()
+    pyplot.show()
+
+
+def ring_experiment(n=3, tstop=150):
+    """Ring network: soma traces plus a spike raster from a single run.
+
+    :param n: number of cells in the ring
+    :param tstop: duration of the run (ms)
+    """
+    clear_network()
+    cells, syns, ncs = build_ring(n)
+    stim = attach_current_clamp(cells[0], amp=0.4)
+    recs = record_network(cells, tstop)
+    # One spike_record call captures every registered cell's spike
+    # detector into a single pair of vectors (ids are the cells' gids)
+    # — no per-NetCon record registration or per-event Python work.
+    spike_t_vec = h.Vector()
+    spike_id_vec = h.Vector()
+    pc.spike_record(-1, spike_t_vec, spike_id_vec)
+    simulate(tstop)
+    t, V = network_traces(recs)
+    fig = pyplot.figure()
+    for i, v in enumerate(V):
+        pyplot.plot(t, v, label='cell %d' % (i + 1))
+    ax = fig.gca()
+    ax.set(xlabel='time (ms)', ylabel='mV')
+    ax.legend()
+    pyplot.show()
+    spikes = group_spikes(spike_t_vec, spike_id_vec, n)
+    sp = spikeplot.SpikePlot(savefig=True)
+    sp.plot_spikes(spikes)
+
+
+def main():
+    global cell1
+    rank = int(pc.id())
+    nhost = int(pc.nhost())
+    if rank == 0:
+        single_cell_experiment()
+    # Every rank joins the sweep; only rank 0 plots it.
+    amplitude_sweep_experiment()
+    # The sweep cell is done with; drop it so the network runs below do
+    # not keep integrating its 82 sections on the side.
+    del cell1
+    clear_network()
+    # Back to fixed-step for the networks: every ExpSyn event forces a
+    # CVODE restart, so variable-step buys nothing once they spike.
+    cvode.active(0)
+    if rank == 0:
+        network_experiment(2, [(0, 1)])
+        network_experiment(3, [(0, 1), (1, 2)])
+        ring_experiment(3)
+    if nhost > 1:
+        pc.done()
+        h.quit()
+
+
+if __name__ == "__main__":
+    main()